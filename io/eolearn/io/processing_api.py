@@ -1,24 +1,77 @@
 """ An input task for the `sentinelhub processing api <https://docs.sentinel-hub.com/api/latest/reference/>`
 """
+import os
 import json
+import time
+import math
+import hashlib
+import tempfile
+import threading
 import logging
+import functools
+import collections
+import concurrent.futures
 import datetime as dt
 import numpy as np
+import dateutil.parser
 
 from sentinelhub import WebFeatureService, MimeType, SentinelHubDownloadClient, DownloadRequest, SHConfig,\
-    bbox_to_dimensions, parse_time_interval, DataSource
+    bbox_to_dimensions, parse_time_interval, DataSource, BBox
 import sentinelhub.sentinelhub_request as shr
 from sentinelhub.time_utils import iso_to_datetime
 
 from eolearn.core import EOPatch, EOTask, FeatureType
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOGGER = logging.getLogger(__name__)
 
+WFS_CACHE_TTL = 24 * 60 * 60
+
+_DEM_EVALSCRIPT = """
+    function setup() {
+        return {
+            input: ["DEM"],
+            output:{
+                id: "default",
+                bands: 1,
+                sampleType: SampleType.UINT16
+            }
+        }
+    }
+
+    function evaluatePixel(sample) {
+        return [sample.DEM]
+    }
+"""
+
+
+def _dump_json(obj):
+    """ Serializes an object into a compact JSON string, using orjson if it is installed
+    """
+    if orjson is None:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+    return orjson.dumps(obj).decode()
+
+
+def _load_json(json_string):
+    """ Parses a JSON string, using orjson if it is installed
+    """
+    if orjson is None:
+        return json.loads(json_string)
+    return orjson.loads(json_string)
+
 
 class SentinelHubInputBase(EOTask):
     """ Base class for Processing API input tasks
     """
-    def __init__(self, data_source, size=None, resolution=None, cache_folder=None, config=None, max_threads=None):
+    MAX_CONCURRENT_REQUESTS = 64
+
+    def __init__(self, data_source, size=None, resolution=None, cache_folder=None, config=None, max_threads=None,
+                 memory_cache_size=0, tile_size=None):
         """
         :param data_source: Source of requested satellite data.
         :type data_source: DataSource
@@ -30,18 +83,40 @@ class SentinelHubInputBase(EOTask):
         :type cache_folder: str
         :param config: An instance of SHConfig defining the service
         :type config: SHConfig or None
-        :param max_threads: Maximum threads to be used when downloading data.
+        :param max_threads: Maximum threads to be used when downloading data. If set to None (default) all requests
+                            are downloaded concurrently, but at most `MAX_CONCURRENT_REQUESTS` at the same time.
         :type max_threads: int
+        :param memory_cache_size: Number of downloaded responses kept in memory and reused by subsequent executions
+                                  with identical requests. If set to a positive number, dates of available
+                                  acquisitions are also kept in memory for at most `WFS_CACHE_TTL` seconds. If set to
+                                  0 (default) neither responses nor dates are kept in memory.
+        :type memory_cache_size: int
+        :param tile_size: If given, requested bounding boxes are enlarged to a grid of tiles with this number of pixels
+                          in each dimension and the downloaded images are cropped back to the requested bounding box.
+                          Dates of available acquisitions are also obtained for the enlarged bounding box, therefore
+                          requests of all bounding boxes within the same tiles are identical and can be served from
+                          cache. It can only be used together with the `resolution` parameter. Note that a bounding
+                          box crossing tile boundaries is enlarged by up to `2 * tile_size` pixels in each dimension,
+                          which can exceed the maximal image size of a single Processing API request.
+        :type tile_size: int or None
         """
 
         if (size is None) == (resolution is None):
             raise ValueError("Exactly one of the parameters 'size' and 'resolution' should be given.")
 
+        if tile_size is not None and resolution is None:
+            raise ValueError("Parameter 'tile_size' can only be used together with parameter 'resolution'.")
+
         self.size = size
         self.resolution = resolution
         self.config = config or SHConfig()
         self.max_threads = max_threads
         self.data_source = data_source
+        self.cache_folder = cache_folder
+        self.memory_cache_size = memory_cache_size
+        self._response_cache = collections.OrderedDict()
+        self._response_cache_lock = threading.Lock()
+        self.tile_size = tile_size
 
         self.request_args = dict(
             url=self.config.get_sh_processing_api_url(),
@@ -68,9 +143,15 @@ class SentinelHubInputBase(EOTask):
         elif self.resolution is not None:
             size_x, size_y = bbox_to_dimensions(eopatch.bbox, self.resolution)
 
+        if self.tile_size:
+            request_bbox = self._snap_to_tile_grid(eopatch.bbox)
+            request_size_x, request_size_y = bbox_to_dimensions(request_bbox, self.resolution)
+        else:
+            request_bbox, request_size_x, request_size_y = eopatch.bbox, size_x, size_y
+
         if time_interval:
             time_interval = parse_time_interval(time_interval)
-            timestamp = self._get_timestamp(time_interval, bbox)
+            timestamp = self._get_timestamp(time_interval, request_bbox)
         else:
             timestamp = None
 
@@ -79,13 +160,13 @@ class SentinelHubInputBase(EOTask):
         elif timestamp:
             eopatch.timestamp = timestamp
 
-        payloads = self._build_payloads(bbox, size_x, size_y, timestamp, time_interval)
-        requests = [DownloadRequest(post_values=payload, **self.request_args) for payload in payloads]
+        payloads = self._build_payloads(request_bbox, request_size_x, request_size_y, timestamp, time_interval)
+        requests = (DownloadRequest(post_values=payload, **self.request_args) for payload in payloads)
 
-        LOGGER.debug('Downloading %d requests of type %s', len(requests), str(self.data_source))
-        client = SentinelHubDownloadClient(config=self.config)
-        images = client.download(requests, max_threads=self.max_threads)
-        LOGGER.debug('Downloads complete')
+        images = self._download(requests)
+
+        if self.tile_size:
+            images = self._crop_images(images, request_bbox, eopatch.bbox, size_x, size_y)
 
         temporal_dim = len(timestamp) if timestamp else 1
         shape = temporal_dim, size_y, size_x
@@ -100,6 +181,113 @@ class SentinelHubInputBase(EOTask):
 
         return eopatch
 
+    def __getstate__(self):
+        """ Responses kept in memory and the lock guarding them are not copied, which allows pickling the task and
+        deep copying it
+        """
+        state = self.__dict__.copy()
+        state['_response_cache'] = collections.OrderedDict()
+        del state['_response_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._response_cache_lock = threading.Lock()
+
+    def _get_resolution(self):
+        """ Returns resolution as a pair of values for X and Y axis
+        """
+        if isinstance(self.resolution, tuple):
+            return self.resolution
+        return self.resolution, self.resolution
+
+    def _snap_to_tile_grid(self, bbox):
+        """ Enlarges the bounding box to the smallest bounding box aligned to the grid of tiles of size `tile_size`
+        """
+        if not bbox.crs.is_utm():
+            raise ValueError("Parameter 'tile_size' can only be used with bounding boxes in UTM coordinate reference "
+                             "systems, got {}".format(bbox.crs))
+
+        res_x, res_y = self._get_resolution()
+        tile_width, tile_height = self.tile_size * res_x, self.tile_size * res_y
+        min_x, min_y, max_x, max_y = list(bbox)
+
+        grid_bbox = [
+            math.floor(min_x / tile_width) * tile_width, math.floor(min_y / tile_height) * tile_height,
+            math.ceil(max_x / tile_width) * tile_width, math.ceil(max_y / tile_height) * tile_height
+        ]
+
+        return BBox(bbox=grid_bbox, crs=bbox.crs)
+
+    def _crop_images(self, images, grid_bbox, bbox, size_x, size_y):
+        """ Crops images downloaded for a bounding box aligned to the tile grid to the requested bounding box
+        """
+        res_x, res_y = self._get_resolution()
+        grid_min_x, _, _, grid_max_y = list(grid_bbox)
+        min_x, _, _, max_y = list(bbox)
+
+        offset_x = int(round((min_x - grid_min_x) / res_x))
+        offset_y = int(round((grid_max_y - max_y) / res_y))
+
+        return [
+            None if img is None else {
+                **img, 'default.tif': img['default.tif'][offset_y: offset_y + size_y, offset_x: offset_x + size_x]
+            }
+            for img in images
+        ]
+
+    def _download(self, requests):
+        """ Downloads the requests, reusing responses of identical requests kept in memory
+        """
+        if not self.memory_cache_size:
+            return self._download_from_service(requests)
+
+        requests = list(requests)
+        request_hashes = [self._request_hash(request) for request in requests]
+
+        with self._response_cache_lock:
+            responses = {request_hash: self._response_cache[request_hash] for request_hash in request_hashes
+                         if request_hash in self._response_cache}
+        missing_requests = {request_hash: request for request_hash, request in zip(request_hashes, requests)
+                            if request_hash not in responses}
+
+        if missing_requests:
+            downloaded = self._download_from_service(list(missing_requests.values()))
+            responses.update(zip(missing_requests, downloaded))
+
+        with self._response_cache_lock:
+            for request_hash, response in responses.items():
+                if response is not None:
+                    self._response_cache[request_hash] = response
+                    self._response_cache.move_to_end(request_hash)
+
+            while len(self._response_cache) > self.memory_cache_size:
+                self._response_cache.popitem(last=False)
+
+        return [responses[request_hash] for request_hash in request_hashes]
+
+    @staticmethod
+    def _request_hash(request):
+        """ Calculates a hash of the request url and payload
+        """
+        hashable = request.url + _dump_json(request.post_values)
+        return hashlib.sha256(hashable.encode()).hexdigest()
+
+    def _download_from_service(self, requests):
+        """ Downloads the requests concurrently, with at most `max_threads` requests in flight at the same time
+
+        Requests can be given as an iterator, in which case each request is created only when it is submitted, while
+        the previously submitted requests are already being downloaded.
+        """
+        max_threads = self.max_threads or self.MAX_CONCURRENT_REQUESTS
+
+        LOGGER.debug('Downloading requests of type %s with at most %d threads', str(self.data_source), max_threads)
+        client = SentinelHubDownloadClient(config=self.config)
+        images = client.download(requests, max_threads=max_threads)
+        LOGGER.debug('Downloaded %d requests', len(images))
+
+        return images
+
     @staticmethod
     def check_timestamp_difference(timestamp1, timestamp2):
         """ Raises an error if the two timestamps are not the same
@@ -122,6 +310,20 @@ class SentinelHubInputBase(EOTask):
         """
         raise NotImplementedError("The _build_payloads method should be implemented by the subclass.")
 
+    @staticmethod
+    def _request_body(bbox, size_x, size_y, request_data, evalscript):
+        """ Build the body of a request for the given data and evalscript, which returns the image in a TIFF and its
+        metadata in a JSON file
+        """
+        responses = [shr.response('default', MimeType.TIFF.get_string()), shr.response('userdata', 'application/json')]
+
+        return shr.body(
+            request_bounds=shr.bounds(crs=bbox.crs.opengis_string, bbox=list(bbox)),
+            request_data=request_data,
+            request_output=shr.output(size_x=size_x, size_y=size_y, responses=responses),
+            evalscript=evalscript
+        )
+
     def _get_timestamp(self, time_interval, bbox):
         """ Get the timestamp array needed as a parameter for downloading the images
         """
@@ -134,9 +336,20 @@ class SentinelHubInputBase(EOTask):
 class SentinelHubInputTask(SentinelHubInputBase):
     """ A processing API input task that loads 16bit integer data and converts it to a 32bit float feature.
     """
+    _TIME_FROM = '__TIME_FROM__'
+    _TIME_TO = '__TIME_TO__'
+    _DATES = '__DATES__'
+
+    MAX_DATES_PER_REQUEST = 30
+
+    ADDITIONAL_DATA_TYPES = {
+        FeatureType.MASK: np.bool
+    }
+
     def __init__(self, data_source, size=None, resolution=None, bands_feature=None, bands=None, additional_data=None,
                  maxcc=1.0, time_difference=None, cache_folder=None, max_threads=None, config=None,
-                 bands_dtype=np.float32, single_scene=False, mosaicking_order='mostRecent'):
+                 bands_dtype=np.float32, single_scene=False, mosaicking_order='mostRecent', memory_cache_size=0,
+                 tile_size=None):
         """
         :param data_source: Source of requested satellite data.
         :type data_source: DataSource
@@ -158,19 +371,37 @@ class SentinelHubInputTask(SentinelHubInputBase):
         :type cache_folder: str
         :param config: An instance of SHConfig defining the service
         :type config: SHConfig or None
-        :param max_threads: Maximum threads to be used when downloading data.
+        :param max_threads: Maximum threads to be used when downloading data. If set to None (default) all requests
+                            are downloaded concurrently, but at most `MAX_CONCURRENT_REQUESTS` at the same time.
         :type max_threads: int
-        :param bands_dtype: dtype of the bands array
+        :param bands_dtype: dtype of the bands array. Bands are normalized with at least 32bit float precision,
+                            therefore a smaller dtype, e.g. np.float16, only reduces the size of the stored feature.
+                            If set to np.int16, bands are not normalized and norm factors are stored in a separate
+                            feature. Bands of other integer dtypes are normalized into a np.float64 array.
         :type bands_dtype: np.dtype
         :param single_scene: If true, the service will compute a single image for the given time interval using
                              mosaicking.
         :type single_scene: bool
         :param mosaicking_order: Mosaicking order, which has to be either 'mostRecent', 'leastRecent' or 'leastCC'.
         :type mosaicking_order: str
+        :param memory_cache_size: Number of downloaded responses kept in memory and reused by subsequent executions
+                                  with identical requests. If set to a positive number, dates of available
+                                  acquisitions are also kept in memory for at most `WFS_CACHE_TTL` seconds. If set to
+                                  0 (default) neither responses nor dates are kept in memory.
+        :type memory_cache_size: int
+        :param tile_size: If given, requested bounding boxes are enlarged to a grid of tiles with this number of pixels
+                          in each dimension and the downloaded images are cropped back to the requested bounding box.
+                          Dates of available acquisitions are also obtained for the enlarged bounding box, therefore
+                          requests of all bounding boxes within the same tiles are identical and can be served from
+                          cache. It can only be used together with the `resolution` parameter. Note that a bounding
+                          box crossing tile boundaries is enlarged by up to `2 * tile_size` pixels in each dimension,
+                          which can exceed the maximal image size of a single Processing API request.
+        :type tile_size: int or None
         """
+        # pylint: disable=too-many-arguments
         super().__init__(
             data_source=data_source, size=size, resolution=resolution, cache_folder=cache_folder, config=config,
-            max_threads=max_threads
+            max_threads=max_threads, memory_cache_size=memory_cache_size, tile_size=tile_size
         )
 
         self.data_source = data_source
@@ -201,37 +432,116 @@ class SentinelHubInputTask(SentinelHubInputBase):
             self.additional_data = list(self._parse_features(additional_data, new_names=True)())
 
         self.all_bands = self.bands + [f_name for _, f_name, _ in self.additional_data]
+        self._band_index = {band: idx for idx, band in enumerate(self.all_bands)}
+        self._evalscript = self.generate_evalscript()
+
+        self._additional_data_layout = [
+            ((f_type, f_name_dst), self._band_index[f_name_src], self.ADDITIONAL_DATA_TYPES.get(f_type, np.uint16))
+            for f_type, f_name_src, f_name_dst in self.additional_data
+        ]
+        self._bands_slice = slice(len(self.bands))
 
     def generate_evalscript(self):
         """ Generate the evalscript to be passed with the request, based on chosen bands
+
+        In case of a single scene the evalscript returns a mosaic of all bands. Otherwise it returns all bands for each
+        of the dates, which are filled into the evalscript as a list of time ranges when the payloads are built.
         """
-        evalscript = """
-            function setup() {{
-                return {{
-                    input: [{{
-                        bands: {bands},
-                        units: "DN"
-                    }}],
-                    output: {{
-                        id:"default",
-                        bands: {num_bands},
-                        sampleType: SampleType.UINT16
+        if self.single_scene:
+            evalscript = """
+                function setup() {{
+                    return {{
+                        input: [{{
+                            bands: {bands},
+                            units: "DN"
+                        }}],
+                        output: {{
+                            id:"default",
+                            bands: {num_bands},
+                            sampleType: SampleType.UINT16
+                        }}
                     }}
                 }}
-            }}
 
-            function updateOutputMetadata(scenes, inputMetadata, outputMetadata) {{
-                outputMetadata.userData = {{ "norm_factor":  inputMetadata.normalizationFactor }}
-            }}
+                function updateOutputMetadata(scenes, inputMetadata, outputMetadata) {{
+                    outputMetadata.userData = {{ "norm_factor":  inputMetadata.normalizationFactor }}
+                }}
 
-            function evaluatePixel(sample) {{
-                return [{samples}]
-            }}
-        """
+                function evaluatePixel(sample) {{
+                    return [{samples}]
+                }}
+            """
+        else:
+            evalscript = """
+                var dates = [{dates}];
+                var sceneIndices = null;
+
+                function setup() {{
+                    return {{
+                        input: [{{
+                            bands: {bands},
+                            units: "DN"
+                        }}],
+                        output: {{
+                            id:"default",
+                            bands: {num_bands} * dates.length,
+                            sampleType: SampleType.UINT16
+                        }},
+                        mosaicking: Mosaicking.ORBIT
+                    }}
+                }}
+
+                function updateOutputMetadata(scenes, inputMetadata, outputMetadata) {{
+                    outputMetadata.userData = {{ "norm_factor":  inputMetadata.normalizationFactor }}
+                }}
+
+                function getAcquisitionDates(orbit) {{
+                    if (orbit.tiles) {{
+                        return orbit.tiles.map(function (tile) {{
+                            return Date.parse(tile.date);
+                        }});
+                    }}
+                    return [Date.parse(orbit.date)];
+                }}
+
+                function matchScenes(scenes) {{
+                    var orbits = scenes.orbits || scenes;
+                    return dates.map(function (range) {{
+                        var timeFrom = Date.parse(range[0]);
+                        var timeTo = Date.parse(range[1]);
+                        for (var i = 0; i < orbits.length; i++) {{
+                            var acquisitionDates = getAcquisitionDates(orbits[i]);
+                            for (var j = 0; j < acquisitionDates.length; j++) {{
+                                if (acquisitionDates[j] >= timeFrom && acquisitionDates[j] <= timeTo) {{
+                                    return i;
+                                }}
+                            }}
+                        }}
+                        throw new Error("No acquisition found between " + range[0] + " and " + range[1]);
+                    }});
+                }}
+
+                function evaluatePixel(samples, scenes) {{
+                    if (sceneIndices === null) {{
+                        sceneIndices = matchScenes(scenes);
+                    }}
+
+                    var result = [];
+                    for (var i = 0; i < dates.length; i++) {{
+                        var sample = samples[sceneIndices[i]];
+                        var values = [{samples}];
+                        for (var j = 0; j < values.length; j++) {{
+                            result.push(values[j]);
+                        }}
+                    }}
+                    return result
+                }}
+            """
 
         samples = ', '.join(['sample.{}'.format(band) for band in self.all_bands])
 
-        return evalscript.format(bands=json.dumps(self.all_bands), num_bands=len(self.all_bands), samples=samples)
+        return evalscript.format(bands=_dump_json(self.all_bands), num_bands=len(self.all_bands), samples=samples,
+                                 dates=self._DATES)
 
     def _get_timestamp(self, time_interval, bbox):
         """ Get the timestamp array needed as a parameter for downloading the images
@@ -239,87 +549,127 @@ class SentinelHubInputTask(SentinelHubInputBase):
         if self.single_scene:
             return [time_interval[0]]
 
-        wfs = WebFeatureService(
-            bbox=bbox, time_interval=time_interval, data_source=self.data_source, maxcc=self.maxcc
-        )
-
-        dates = wfs.get_dates()
+        dates = get_available_dates(bbox, time_interval, self.data_source, self.maxcc, cache_folder=self.cache_folder,
+                                    memory_cache=bool(self.memory_cache_size))
 
         if len(dates) == 0:
             raise ValueError("No available images for requested time range: {}".format(time_interval))
 
         dates = sorted(dates)
 
-        return [dates[0]] + [d2 for d1, d2 in zip(dates[:-1], dates[1:]) if d2 - d1 > self.time_difference]
+        time_deltas = np.diff(np.array(dates, dtype='datetime64[us]'))
+        is_new_date = np.concatenate(([True], time_deltas > np.timedelta64(self.time_difference)))
+
+        return [dates[idx] for idx in np.nonzero(is_new_date)[0]]
 
     def _build_payloads(self, bbox, size_x, size_y, timestamp, time_interval):
         """ Build payloads for the requests to the service
+
+        Unless a single scene is requested, dates are grouped into chunks of at most `MAX_DATES_PER_REQUEST` dates
+        and each chunk is downloaded with a single multi-temporal request.
         """
-        if self.single_scene:
-            dates = [(iso_to_datetime(time_interval[0]), iso_to_datetime(time_interval[1]))]
-        else:
-            dates = [(date - self.time_difference, date + self.time_difference) for date in timestamp]
+        payload_template = self._request_payload_template(bbox, size_x, size_y)
 
-        return [self._request_payload(date1, date2, bbox, size_x, size_y) for date1, date2 in dates]
+        if self.single_scene:
+            date_range = iso_to_datetime(time_interval[0]), iso_to_datetime(time_interval[1])
+            return [self._request_payload(payload_template, [date_range])]
 
-    def _request_payload(self, date_from, date_to, bbox, size_x, size_y):
-        """ Build the payload dictionary for the request
-        """
-        time_from, time_to = date_from.isoformat() + 'Z', date_to.isoformat() + 'Z'
+        date_ranges = [(date - self.time_difference, date + self.time_difference) for date in timestamp]
+        chunk_size = self.MAX_DATES_PER_REQUEST
 
-        responses = [shr.response('default', MimeType.TIFF.get_string()), shr.response('userdata', 'application/json')]
+        return (
+            self._request_payload(payload_template, date_ranges[idx: idx + chunk_size])
+            for idx in range(0, len(date_ranges), chunk_size)
+        )
 
-        data = shr.data(time_from=time_from, time_to=time_to, data_type=self.data_source.api_identifier())
+    def _request_payload_template(self, bbox, size_x, size_y):
+        """ Build the payload for the request once and serialize it into a JSON string with placeholders in place of
+        the time range and dates, so that payloads can be produced by a cheap string substitution
+        """
+        data = shr.data(time_from=self._TIME_FROM, time_to=self._TIME_TO, data_type=self.data_source.api_identifier())
         data['dataFilter']['maxCloudCoverage'] = int(self.maxcc * 100)
         data['dataFilter']['mosaickingOrder'] = self.mosaicking_order
 
-        return shr.body(
-            request_bounds=shr.bounds(crs=bbox.crs.opengis_string, bbox=list(bbox)),
-            request_data=[data],
-            request_output=shr.output(size_x=size_x, size_y=size_y, responses=responses),
-            evalscript=self.generate_evalscript()
-        )
+        payload = self._request_body(bbox, size_x, size_y, [data], self._evalscript)
+
+        return _dump_json(payload)
+
+    def _request_payload(self, payload_template, date_ranges):
+        """ Build the payload dictionary for the request by filling the time ranges into the payload template
+        """
+        date_ranges = [(date_from.isoformat() + 'Z', date_to.isoformat() + 'Z') for date_from, date_to in date_ranges]
+        dates = ', '.join("['{}', '{}']".format(time_from, time_to) for time_from, time_to in date_ranges)
+
+        payload = payload_template.replace(self._TIME_FROM, date_ranges[0][0])
+        payload = payload.replace(self._TIME_TO, date_ranges[-1][1])
+        payload = payload.replace(self._DATES, dates)
+
+        return _load_json(payload)
 
     def _extract_data(self, eopatch, images, shape):
         """ Extract data from the received images and assign them to eopatch features
         """
+        data, norm_factors = self._stack_dates(images, shape)
 
-        images = ((img['default.tif'], img['userdata.json']) for img in images)
-        images = [(img, meta.get('norm_factor', 0)) for img, meta in images]
-
-        for f_type, f_name_src, f_name_dst in self.additional_data:
-            eopatch[(f_type, f_name_dst)] = self._extract_additional_data(images, f_type, f_name_src, shape)
+        for feature, idx, dst_type in self._additional_data_layout:
+            eopatch[feature] = data[..., idx: idx + 1].astype(dst_type)
 
         if self.bands:
-            self._extract_bands(eopatch, images, shape)
+            self._extract_bands(eopatch, data, norm_factors)
 
-    def _extract_additional_data(self, images, f_type, f_name, shape):
-        """ extract additional_data from the received images each as a separate feature
+    def _stack_dates(self, images, shape):
+        """ Stack images of multi-temporal requests into a single array of shape (time, height, width, bands) and
+        collect the norm factors of all dates
         """
-        type_dict = {
-            FeatureType.MASK: np.bool
-        }
+        num_dates, size_y, size_x = shape
+
+        data = np.empty((num_dates, size_y, size_x, len(self.all_bands)), dtype=np.uint16)
+        norm_factors = np.empty(num_dates, dtype=np.float64)
 
-        dst_type = type_dict.get(f_type, np.uint16)
+        start_idx = 0
+        for img in images:
+            tif = np.atleast_3d(img['default.tif']).reshape(size_y, size_x, -1, len(self.all_bands))
+            end_idx = start_idx + tif.shape[2]
 
-        idx = self.all_bands.index(f_name)
-        feature_arrays = [np.atleast_3d(img)[..., idx] for img, norm_factor in images]
+            data[start_idx: end_idx] = tif.transpose(2, 0, 1, 3)
+            norm_factors[start_idx: end_idx] = img['userdata.json'].get('norm_factor', 0)
 
-        return np.asarray(feature_arrays, dtype=dst_type).reshape(*shape, 1)
+            start_idx = end_idx
 
-    def _extract_bands(self, eopatch, images, shape):
-        num_bands = len(self.bands)
+        if start_idx != num_dates:
+            raise ValueError('Expected {} dates in the downloaded images, got {}'.format(num_dates, start_idx))
 
-        bands = [img[..., :num_bands].astype(self.bands_dtype) for img, _ in images]
-        norms = [norm_factor for _, norm_factor in images]
+        return data, norm_factors
+
+    def _extract_bands(self, eopatch, data, norm_factors):
+        bands_data = data[..., self._bands_slice]
 
         if self.bands_dtype == np.int16:
-            norms = np.asarray(norms).reshape(shape[0], 1).astype(np.float32)
-            eopatch[(FeatureType.SCALAR, 'NORM_FACTORS')] = norms
+            eopatch[(FeatureType.SCALAR, 'NORM_FACTORS')] = norm_factors.reshape(-1, 1).astype(np.float32)
+            bands = bands_data.astype(self.bands_dtype)
+        elif np.issubdtype(self.bands_dtype, np.floating):
+            bands = np.empty(bands_data.shape, dtype=np.promote_types(self.bands_dtype, np.float32))
+
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(self._normalize_bands, bands_data, norm_factors, bands))
+
+            if bands.dtype != self.bands_dtype:
+                bands = bands.astype(self.bands_dtype)
         else:
-            bands = [np.round(band * norm, 4) for band, norm in zip(bands, norms)]
+            bands_data = bands_data.astype(self.bands_dtype, copy=False)
+            bands = np.empty(bands_data.shape, dtype=np.float64)
 
-        eopatch[self.bands_feature] = np.asarray(bands).reshape(*shape, num_bands)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(self._normalize_bands, bands_data, norm_factors, bands))
+
+        eopatch[self.bands_feature] = bands
+
+    @staticmethod
+    def _normalize_bands(bands_data, norm_factor, out):
+        """ Multiplies bands of a single date with the norm factor and writes them into the output array. Numpy
+        releases the GIL during the multiplication, therefore dates can be normalized in parallel threads
+        """
+        np.multiply(bands_data, norm_factor, out=out, dtype=out.dtype)
 
     def _add_meta_info(self, eopatch):
         eopatch.meta_info['maxcc'] = self.maxcc
@@ -330,7 +680,7 @@ class SentinelHubDemTask(SentinelHubInputBase):
     """ A processing API input task that downloads the digital elevation model
     """
     def __init__(self, dem_feature, size=None, resolution=None, cache_folder=None, config=None,
-                 max_threads=None):
+                 max_threads=None, memory_cache_size=0, tile_size=None):
         """
         :param dem_feature: Target feature into which to save the DEM array.
         :type dem_feature: tuple(sentinelhub.FeatureType, str)
@@ -342,13 +692,24 @@ class SentinelHubDemTask(SentinelHubInputBase):
         :type cache_folder: str
         :param config: An instance of SHConfig defining the service
         :type config: SHConfig or None
-        :param max_threads: Maximum threads to be used when downloading data.
+        :param max_threads: Maximum threads to be used when downloading data. If set to None (default) all requests
+                            are downloaded concurrently, but at most `MAX_CONCURRENT_REQUESTS` at the same time.
         :type max_threads: int
+        :param memory_cache_size: Number of downloaded responses kept in memory and reused by subsequent executions
+                                  with identical requests. If set to 0 (default) responses are not kept in memory.
+        :type memory_cache_size: int
+        :param tile_size: If given, requested bounding boxes are enlarged to a grid of tiles with this number of pixels
+                          in each dimension and the downloaded images are cropped back to the requested bounding box.
+                          This way overlapping requests become identical and can be served from cache. It can only be
+                          used together with the `resolution` parameter. Note that a bounding box crossing tile
+                          boundaries is enlarged by up to `2 * tile_size` pixels in each dimension, which can exceed
+                          the maximal image size of a single Processing API request.
+        :type tile_size: int or None
         """
 
         super().__init__(
             data_source=DataSource.DEM, size=size, resolution=resolution, cache_folder=cache_folder, config=config,
-            max_threads=max_threads
+            max_threads=max_threads, memory_cache_size=memory_cache_size, tile_size=tile_size
         )
 
         feature_parser = self._parse_features(
@@ -362,32 +723,7 @@ class SentinelHubDemTask(SentinelHubInputBase):
     def _build_payloads(self, bbox, size_x, size_y, timestamp, time_interval):
         """ Build payloads for the requests to the service
         """
-        evalscript = """
-            function setup() {
-                return {
-                    input: ["DEM"],
-                    output:{
-                        id: "default",
-                        bands: 1,
-                        sampleType: SampleType.UINT16
-                    }
-                }
-            }
-
-            function evaluatePixel(sample) {
-                return [sample.DEM]
-            }
-        """
-
-        responses = [shr.response('default', 'image/tiff'), shr.response('userdata', 'application/json')]
-        request_body = shr.body(
-            request_bounds=shr.bounds(crs=bbox.crs.opengis_string, bbox=list(bbox)),
-            request_data=[{"type": "DEM"}],
-            request_output=shr.output(size_x=size_x, size_y=size_y, responses=responses),
-            evalscript=evalscript
-        )
-
-        return [request_body]
+        return [self._request_body(bbox, size_x, size_y, [{"type": "DEM"}], _DEM_EVALSCRIPT)]
 
     def _extract_data(self, eopatch, images, shape):
         """ Extract data from the received images and assign them to eopatch features
@@ -395,3 +731,84 @@ class SentinelHubDemTask(SentinelHubInputBase):
         tif = images[0]['default.tif']
 
         eopatch[self.dem_feature] = tif[..., np.newaxis].astype(np.int16)
+
+
+def get_available_dates(bbox, time_interval, data_source, maxcc, cache_folder=None, memory_cache=False):
+    """ Get dates of available acquisitions from the WFS service
+
+    If `cache_folder` is given, results are cached on disk, and if `memory_cache` is enabled, they are also cached in
+    memory, so that repeated queries with the same parameters don't require a request to the service. Cached results
+    are used for at most `WFS_CACHE_TTL` seconds.
+
+    :param bbox: Bounding box of the area of interest
+    :type bbox: sentinelhub.BBox
+    :param time_interval: Time interval, as a pair of ISO strings
+    :type time_interval: (str, str)
+    :param data_source: Source of requested satellite data
+    :type data_source: DataSource
+    :param maxcc: Maximum cloud coverage
+    :type maxcc: float
+    :param cache_folder: Path to cache_folder. If set to None (default) results will not be cached on disk.
+    :type cache_folder: str or None
+    :param memory_cache: If True, results will be cached in memory. Default is False.
+    :type memory_cache: bool
+    :return: A list of dates of available acquisitions
+    :rtype: list(datetime.datetime)
+    """
+    query = tuple(bbox), bbox.crs, tuple(time_interval), data_source, maxcc, cache_folder
+
+    if memory_cache:
+        ttl_period = int(time.time() // WFS_CACHE_TTL)
+        return list(_get_memory_cached_dates(*query, ttl_period))
+
+    return list(_get_available_dates(*query))
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_memory_cached_dates(bbox_coords, crs, time_interval, data_source, maxcc, cache_folder, ttl_period):
+    """ Get available dates and cache them in memory. Parameters are hashable, which allows caching results with
+    `lru_cache`. Because `ttl_period` changes every `WFS_CACHE_TTL` seconds, results cached in memory expire at the
+    latest after that time
+    """
+    # pylint: disable=unused-argument
+    return _get_available_dates(bbox_coords, crs, time_interval, data_source, maxcc, cache_folder)
+
+
+def _get_available_dates(bbox_coords, crs, time_interval, data_source, maxcc, cache_folder):
+    """ Get available dates from the cache folder or from the WFS service
+    """
+    cache_filename = None
+    if cache_folder:
+        cache_key = repr((bbox_coords, crs, time_interval, data_source, maxcc)).encode()
+        cache_filename = os.path.join(cache_folder, 'wfs', '{}.json'.format(hashlib.sha1(cache_key).hexdigest()))
+
+        if os.path.exists(cache_filename) and time.time() - os.path.getmtime(cache_filename) < WFS_CACHE_TTL:
+            with open(cache_filename, 'r') as cache_file:
+                return tuple(dateutil.parser.parse(date) for date in json.load(cache_file))
+
+    wfs = WebFeatureService(
+        bbox=BBox(bbox=bbox_coords, crs=crs), time_interval=time_interval, data_source=data_source, maxcc=maxcc
+    )
+    dates = tuple(wfs.get_dates())
+
+    if cache_filename:
+        _write_dates_cache(cache_filename, dates)
+
+    return dates
+
+
+def _write_dates_cache(cache_filename, dates):
+    """ Writes dates into a temporary file, which then replaces the cache file, so that other processes never read a
+    partially written cache file
+    """
+    cache_dir = os.path.dirname(cache_filename)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    file_descriptor, temp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            json.dump([date.isoformat() for date in dates], temp_file)
+        os.replace(temp_filename, cache_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
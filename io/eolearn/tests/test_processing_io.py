@@ -1,12 +1,22 @@
 """ Testing SentinelHubInputTask
 """
 
+import os
+import sys
+import copy
+import json
+import pickle
+import tempfile
 import unittest
 import datetime as dt
-from sentinelhub import CRS, BBox, DataSource
+import concurrent.futures
+from unittest.mock import patch
+import numpy as np
+from sentinelhub import CRS, BBox, DataSource, DownloadRequest
 
 from eolearn.io import SentinelHubInputTask, SentinelHubDemTask
-from eolearn.core import FeatureType
+from eolearn.io.processing_api import get_available_dates, _get_memory_cached_dates
+from eolearn.core import EOPatch, FeatureType
 
 # import sys
 # import logging
@@ -46,6 +56,8 @@ class TestProcessingIO(unittest.TestCase):
         self.assertTrue(bands.shape == (4, height, width, 13))
         self.assertTrue(is_data.shape == (4, height, width, 1))
         self.assertTrue(len(eopatch.timestamp) == 4)
+        self.assertTrue(np.all(np.any(is_data, axis=(1, 2, 3))), msg='Each date should contain some valid data')
+        self.assertTrue(np.all(np.any(bands > 0, axis=(1, 2, 3))), msg='Each date should contain non-zero bands')
 
     def test_specific_bands(self):
         """ Download S2L1C bands and dataMask
@@ -150,5 +162,394 @@ class TestProcessingIO(unittest.TestCase):
             SentinelHubDemTask(resolution=10, dem_feature=(FeatureType.DATA, 'DEM'), max_threads=3)
 
 
+class TestProcessingPayloads(unittest.TestCase):
+    """ Test cases for building request payloads, which don't require access to the service
+    """
+    size = (99, 101)
+    bbox = BBox(bbox=[268892, 4624365, 268892+size[0]*10, 4624365+size[1]*10], crs=CRS.UTM_33N)
+    time_difference = dt.timedelta(minutes=60)
+    timestamp = [dt.datetime(2017, 12, 15, 10, 12, 3), dt.datetime(2017, 12, 20, 10, 12, 1)]
+
+    def test_multi_temporal_payload(self):
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            bands=['B02', 'B03'],
+            additional_data=[(FeatureType.MASK, 'dataMask')],
+            size=self.size,
+            time_difference=self.time_difference,
+            data_source=DataSource.SENTINEL2_L1C
+        )
+
+        payloads = list(task._build_payloads(self.bbox, *self.size, self.timestamp, None))
+        self.assertEqual(len(payloads), 1)
+
+        payload = payloads[0]
+        self.assertEqual(payload['input']['data'][0]['dataFilter']['timeRange'],
+                         {'from': '2017-12-15T09:12:03Z', 'to': '2017-12-20T11:12:01Z'})
+        self.assertEqual(payload['input']['data'][0]['dataFilter']['maxCloudCoverage'], 100)
+        self.assertEqual(payload['output']['width'], self.size[0])
+
+        evalscript = payload['evalscript']
+        self.assertIn("var dates = [['2017-12-15T09:12:03Z', '2017-12-15T11:12:03Z'], "
+                      "['2017-12-20T09:12:01Z', '2017-12-20T11:12:01Z']]", evalscript)
+
+        serialized_payload = json.dumps(payload)
+        for placeholder in ['__TIME_FROM__', '__TIME_TO__', '__DATES__']:
+            self.assertNotIn(placeholder, serialized_payload)
+
+    def test_single_scene_payload(self):
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            bands=['B02', 'B03'],
+            size=self.size,
+            data_source=DataSource.SENTINEL2_L1C,
+            single_scene=True
+        )
+
+        time_interval = ('2017-12-15T00:00:00', '2017-12-30T00:00:00')
+        payloads = list(task._build_payloads(self.bbox, *self.size, None, time_interval))
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(payloads[0]['input']['data'][0]['dataFilter']['timeRange'],
+                         {'from': '2017-12-15T00:00:00Z', 'to': '2017-12-30T00:00:00Z'})
+        self.assertNotIn('__', json.dumps(payloads[0]))
+
+    @staticmethod
+    def _get_image(date_indices, num_bands, norm_factor, size_y=3, size_x=2):
+        """ Creates a synthetic image of a multi-temporal request, where each value encodes its date and band index
+        """
+        values = [10 * date_idx + band_idx for date_idx in date_indices for band_idx in range(num_bands)]
+        tif = np.broadcast_to(np.array(values, dtype=np.uint16), (size_y, size_x, len(values)))
+        if len(values) == 1:
+            tif = tif[..., 0]
+        return {'default.tif': tif, 'userdata.json': {'norm_factor': norm_factor}}
+
+    def test_stack_dates(self):
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            bands=['B02', 'B03'],
+            additional_data=[(FeatureType.MASK, 'dataMask')],
+            size=(2, 3),
+            data_source=DataSource.SENTINEL2_L1C
+        )
+
+        images = [self._get_image([0, 1], 3, 0.0001), self._get_image([2], 3, 0.0002)]
+        data, norm_factors = task._stack_dates(images, (3, 3, 2))
+
+        self.assertEqual(data.shape, (3, 3, 2, 3))
+        for date_idx in range(3):
+            for band_idx in range(3):
+                self.assertTrue(np.all(data[date_idx, ..., band_idx] == 10 * date_idx + band_idx))
+
+        self.assertEqual(norm_factors.dtype, np.float64)
+        self.assertTrue(np.array_equal(norm_factors, [0.0001, 0.0001, 0.0002]))
+
+    def test_stack_single_band_dates(self):
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            bands=['B02'],
+            size=(2, 3),
+            data_source=DataSource.SENTINEL2_L1C
+        )
+
+        images = [self._get_image([0], 1, 0.0001), self._get_image([1], 1, 0.0002)]
+        self.assertEqual(images[0]['default.tif'].ndim, 2)
+
+        data, norm_factors = task._stack_dates(images, (2, 3, 2))
+        self.assertTrue(np.array_equal(data[..., 0], [np.zeros((3, 2)), np.full((3, 2), 10)]))
+        self.assertTrue(np.array_equal(norm_factors, [0.0001, 0.0002]))
+
+        with self.assertRaises(ValueError, msg='Expected a ValueError when images contain fewer dates'):
+            task._stack_dates(images, (3, 3, 2))
+
+    def test_bands_dtype(self):
+        images = [self._get_image([1000, 2000], 2, 0.0001), self._get_image([3000], 2, 0.0002)]
+        expected_values = np.array([[10000, 10001], [20000, 20001], [30000, 30001]]) * [[0.0001], [0.0001], [0.0002]]
+
+        for bands_dtype, expected_dtype in [(np.float32, np.float32), (np.float16, np.float16),
+                                            (np.float64, np.float64), (np.uint16, np.float64)]:
+            task = SentinelHubInputTask(
+                bands_feature=(FeatureType.DATA, 'BANDS'),
+                bands=['B02', 'B03'],
+                size=(2, 3),
+                data_source=DataSource.SENTINEL2_L1C,
+                bands_dtype=bands_dtype
+            )
+
+            eopatch = EOPatch()
+            task._extract_data(eopatch, images, (3, 3, 2))
+
+            bands = eopatch[(FeatureType.DATA, 'BANDS')]
+            self.assertEqual(bands.dtype, expected_dtype)
+            self.assertEqual(bands.shape, (3, 3, 2, 2))
+            self.assertTrue(np.allclose(bands, expected_values[:, np.newaxis, np.newaxis, :], rtol=1e-3, atol=0))
+
+
+class TestTimestampFiltering(unittest.TestCase):
+    """ Test cases for filtering dates of available acquisitions, with a stubbed WFS service
+    """
+    time_interval = ('2017-12-15T00:00:00', '2017-12-30T23:59:59')
+
+    def _get_timestamp(self, dates, time_difference=None):
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            size=(2, 3),
+            time_difference=time_difference,
+            data_source=DataSource.SENTINEL2_L1C
+        )
+
+        with patch('eolearn.io.processing_api.get_available_dates', return_value=dates):
+            return task._get_timestamp(self.time_interval, BBox((0, 0, 1, 1), crs=CRS.WGS84))
+
+    def test_time_difference(self):
+        dates = [dt.datetime(2017, 12, 20, 10, 30), dt.datetime(2017, 12, 15, 10, 0), dt.datetime(2017, 12, 15, 11, 0),
+                 dt.datetime(2017, 12, 15, 12, 0, 0, 1), dt.datetime(2017, 12, 20, 10, 0)]
+
+        timestamp = self._get_timestamp(dates, time_difference=dt.timedelta(minutes=60))
+        self.assertEqual(timestamp, [dt.datetime(2017, 12, 15, 10, 0), dt.datetime(2017, 12, 15, 12, 0, 0, 1),
+                                     dt.datetime(2017, 12, 20, 10, 0)])
+
+    def test_sub_second_dates(self):
+        dates = [dt.datetime(2017, 12, 15, 10, 0, 0), dt.datetime(2017, 12, 15, 10, 0, 0, 500000),
+                 dt.datetime(2017, 12, 15, 10, 0, 1, 1), dt.datetime(2017, 12, 15, 10, 0, 2, 600000),
+                 dt.datetime(2017, 12, 15, 10, 0, 3, 600000), dt.datetime(2017, 12, 15, 10, 0, 4, 600001)]
+
+        timestamp = self._get_timestamp(dates)
+        self.assertEqual(timestamp, [dt.datetime(2017, 12, 15, 10, 0, 0), dt.datetime(2017, 12, 15, 10, 0, 2, 600000),
+                                     dt.datetime(2017, 12, 15, 10, 0, 4, 600001)])
+
+    def test_single_date(self):
+        dates = [dt.datetime(2017, 12, 15, 10, 0, 0, 123)]
+        self.assertEqual(self._get_timestamp(dates), dates)
+
+        with self.assertRaises(ValueError, msg='Expected a ValueError when no dates are available'):
+            self._get_timestamp([])
+
+
+class TestAvailableDatesCache(unittest.TestCase):
+    """ Test cases for caching of dates obtained from the WFS service
+    """
+    bbox = BBox(bbox=[268892, 4624365, 269882, 4625375], crs=CRS.UTM_33N)
+    time_interval = ('2017-12-15T00:00:00', '2017-12-30T23:59:59')
+    dates = [dt.datetime(2017, 12, 17, 10, 3, 21), dt.datetime(2017, 12, 17, 10, 3, 40)]
+
+    def setUp(self):
+        _get_memory_cached_dates.cache_clear()
+
+    @patch('eolearn.io.processing_api.WebFeatureService')
+    def test_memory_cache(self, wfs_mock):
+        wfs_mock.return_value.get_dates.return_value = self.dates
+
+        for _ in range(2):
+            dates = get_available_dates(self.bbox, self.time_interval, DataSource.SENTINEL2_L1C, 0.8,
+                                        memory_cache=True)
+            self.assertEqual(dates, self.dates)
+
+        self.assertEqual(wfs_mock.call_count, 1)
+
+    @patch('eolearn.io.processing_api.WebFeatureService')
+    def test_no_cache(self, wfs_mock):
+        wfs_mock.return_value.get_dates.return_value = self.dates
+
+        for _ in range(2):
+            dates = get_available_dates(self.bbox, self.time_interval, DataSource.SENTINEL2_L1C, 0.8)
+            self.assertEqual(dates, self.dates)
+
+        self.assertEqual(wfs_mock.call_count, 2, msg='Dates should not be cached in memory by default')
+
+    @patch('eolearn.io.processing_api.WebFeatureService')
+    def test_disk_cache(self, wfs_mock):
+        wfs_mock.return_value.get_dates.return_value = self.dates
+
+        with tempfile.TemporaryDirectory() as cache_folder:
+            dates = get_available_dates(self.bbox, self.time_interval, DataSource.SENTINEL2_L1C, 0.8,
+                                        cache_folder=cache_folder)
+            self.assertEqual(dates, self.dates)
+
+            cache_files = os.listdir(os.path.join(cache_folder, 'wfs'))
+            self.assertEqual(len(cache_files), 1)
+            self.assertTrue(cache_files[0].endswith('.json'), msg='Temporary cache files should be removed')
+
+            cached_dates = get_available_dates(self.bbox, self.time_interval, DataSource.SENTINEL2_L1C, 0.8,
+                                               cache_folder=cache_folder)
+            self.assertEqual(cached_dates, self.dates, msg='Dates read from disk cache should keep their times')
+
+        self.assertEqual(wfs_mock.call_count, 1)
+
+
+class TestResponseCache(unittest.TestCase):
+    """ Test cases for the in-memory cache of downloaded responses, with a stubbed download client
+    """
+    @staticmethod
+    def _download_stub(requests, max_threads=None):
+        return [None if request.post_values['id'] is None else dict(request.post_values) for request in requests]
+
+    def _get_requests(self, task, ids):
+        return [DownloadRequest(post_values={'id': request_id}, **task.request_args) for request_id in ids]
+
+    def _get_task(self, memory_cache_size):
+        return SentinelHubDemTask(resolution=10, dem_feature=(FeatureType.DATA_TIMELESS, 'DEM'),
+                                  memory_cache_size=memory_cache_size)
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_cache_hits(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=3)
+
+        self.assertEqual(task._download(self._get_requests(task, [1, 2])), [{'id': 1}, {'id': 2}])
+        self.assertEqual(task._download(self._get_requests(task, [2, 3, 1])), [{'id': 2}, {'id': 3}, {'id': 1}])
+
+        downloaded_ids = [[request.post_values['id'] for request in call[0][0]]
+                          for call in client_mock.return_value.download.call_args_list]
+        self.assertEqual(downloaded_ids, [[1, 2], [3]])
+
+        task._download(self._get_requests(task, [1, 2, 3]))
+        self.assertEqual(client_mock.return_value.download.call_count, 2, msg='All responses should be cached')
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_cache_eviction(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=2)
+
+        task._download(self._get_requests(task, [1, 2]))
+        task._download(self._get_requests(task, [1]))
+        task._download(self._get_requests(task, [3]))
+        self.assertEqual(list(task._response_cache.values()), [{'id': 1}, {'id': 3}])
+
+        task._download(self._get_requests(task, [2]))
+        self.assertEqual(client_mock.return_value.download.call_count, 3)
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_repeated_requests(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=2)
+
+        responses = task._download(self._get_requests(task, [1, 1, 2]))
+        self.assertEqual(responses, [{'id': 1}, {'id': 1}, {'id': 2}])
+
+        downloaded_requests = client_mock.return_value.download.call_args[0][0]
+        self.assertEqual(len(downloaded_requests), 2, msg='Identical requests should be downloaded only once')
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_failed_downloads_not_cached(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=2)
+
+        self.assertEqual(task._download(self._get_requests(task, [None])), [None])
+        self.assertEqual(len(task._response_cache), 0)
+
+        task._download(self._get_requests(task, [None]))
+        self.assertEqual(client_mock.return_value.download.call_count, 2)
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_concurrent_downloads(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=3)
+
+        request_ids = [[idx % 7, (idx * 3) % 5 + 7] for idx in range(2000)]
+
+        def download(ids):
+            return task._download(self._get_requests(task, ids))
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                responses = list(executor.map(download, request_ids))
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        self.assertEqual(responses, [[{'id': idx} for idx in ids] for ids in request_ids])
+        self.assertLessEqual(len(task._response_cache), 3)
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    def test_copy_task(self, client_mock):
+        client_mock.return_value.download.side_effect = self._download_stub
+        task = self._get_task(memory_cache_size=3)
+        task._download(self._get_requests(task, [1]))
+
+        for task_copy in [copy.deepcopy(task), pickle.loads(pickle.dumps(task))]:
+            self.assertEqual(len(task_copy._response_cache), 0)
+            self.assertEqual(task_copy._download(self._get_requests(task_copy, [1])), [{'id': 1}])
+
+
+class TestTileGrid(unittest.TestCase):
+    """ Test cases for snapping bounding boxes to the grid of tiles and cropping the downloaded images
+    """
+    def setUp(self):
+        self.task = SentinelHubDemTask(resolution=10, dem_feature=(FeatureType.DATA_TIMELESS, 'DEM'), tile_size=100)
+
+    @staticmethod
+    def _get_grid_image(grid_bbox, resolution):
+        min_x, min_y, max_x, max_y = list(grid_bbox)
+        size_x, size_y = int((max_x - min_x) / resolution), int((max_y - min_y) / resolution)
+        return np.arange(size_x * size_y).reshape(size_y, size_x)
+
+    def test_snap_and_crop(self):
+        bbox = BBox((1250, 3100, 1750, 3600), crs=CRS.UTM_33N)
+
+        grid_bbox = self.task._snap_to_tile_grid(bbox)
+        self.assertEqual(list(grid_bbox), [1000, 3000, 2000, 4000])
+        self.assertEqual(grid_bbox.crs, CRS.UTM_33N)
+
+        image = self._get_grid_image(grid_bbox, 10)
+        cropped, = self.task._crop_images([{'default.tif': image}], grid_bbox, bbox, 50, 50)
+
+        self.assertEqual(cropped['default.tif'].shape, (50, 50))
+        self.assertTrue(np.array_equal(cropped['default.tif'], image[40:90, 25:75]))
+
+    def test_tile_boundary(self):
+        bbox = BBox((1800, 3900, 2300, 4200), crs=CRS.UTM_33N)
+
+        grid_bbox = self.task._snap_to_tile_grid(bbox)
+        self.assertEqual(list(grid_bbox), [1000, 3000, 3000, 5000])
+
+        image = self._get_grid_image(grid_bbox, 10)
+        self.assertEqual(image.shape, (200, 200), msg='Request should span 2 tiles in each dimension')
+
+        cropped, missing = self.task._crop_images([{'default.tif': image}, None], grid_bbox, bbox, 50, 30)
+        self.assertTrue(np.array_equal(cropped['default.tif'], image[80:110, 80:130]))
+        self.assertIsNone(missing)
+
+    @patch('eolearn.io.processing_api.SentinelHubDownloadClient')
+    @patch('eolearn.io.processing_api.get_available_dates')
+    def test_execute_neighbouring_patches(self, dates_mock, client_mock):
+        def available_dates(bbox, *_, **__):
+            is_grid_bbox = list(bbox) == [1000, 3000, 2000, 4000]
+            return [dt.datetime(2017, 12, 15, 10, 0)] if is_grid_bbox else [dt.datetime(2017, 12, 16, 10, 0)]
+
+        def download_stub(requests, max_threads=None):
+            return [{'default.tif': self._get_grid_image([1000, 3000, 2000, 4000], 10).astype(np.uint16),
+                     'userdata.json': {'norm_factor': 0.0001}} for _ in requests]
+
+        dates_mock.side_effect = available_dates
+        client_mock.return_value.download.side_effect = download_stub
+
+        task = SentinelHubInputTask(
+            bands_feature=(FeatureType.DATA, 'BANDS'),
+            bands=['B02'],
+            resolution=10,
+            tile_size=100,
+            memory_cache_size=2,
+            data_source=DataSource.SENTINEL2_L1C
+        )
+
+        time_interval = ('2017-12-15', '2017-12-30')
+        eopatch1 = task.execute(bbox=BBox((1250, 3100, 1500, 3600), crs=CRS.UTM_33N), time_interval=time_interval)
+        eopatch2 = task.execute(bbox=BBox((1500, 3100, 1750, 3600), crs=CRS.UTM_33N), time_interval=time_interval)
+
+        self.assertEqual(eopatch1.timestamp, [dt.datetime(2017, 12, 15, 10, 0)])
+        self.assertEqual(eopatch2.timestamp, eopatch1.timestamp)
+        self.assertEqual(client_mock.return_value.download.call_count, 1, msg='Both patches should share a request')
+
+        image = self._get_grid_image([1000, 3000, 2000, 4000], 10) * 0.0001
+        self.assertTrue(np.allclose(eopatch1.data['BANDS'][0, ..., 0], image[40:90, 25:50]))
+        self.assertTrue(np.allclose(eopatch2.data['BANDS'][0, ..., 0], image[40:90, 50:75]))
+
+    def test_non_utm_bbox(self):
+        bbox = BBox((46.16, -16.15, 46.51, -15.58), crs=CRS.WGS84)
+        with self.assertRaises(ValueError):
+            self.task._snap_to_tile_grid(bbox)
+
+
 if __name__ == "__main__":
     unittest.main()